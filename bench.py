@@ -0,0 +1,216 @@
+""" Microbenchmarks des chemins chauds de la conversion et des correspondances d'ID, sur des structures synthétiques.
+
+    python3 bench.py run --out _bench/baseline.json
+    python3 bench.py run --out _bench/current.json
+    python3 bench.py compare _bench/baseline.json _bench/current.json --threshold 20
+"""
+import argparse, contextlib, io, json, os, sys, tempfile, time
+
+from main import Comparator, logger
+
+SIZES = [10, 40, 160]
+FIELDS_PER_TABLE = 10
+DB_NAME = "bench"
+
+
+class SyntheticInstance():
+    """ Remplace MetabaseAPI : une structure générée, sans aucune requête.
+    """
+    def __init__(self, name, STRUCTURE) -> None:
+        self.name = name
+        self.STRUCTURE = STRUCTURE
+        self.VERSION = "bench"
+        self.need_reload = False
+
+
+def field_id(offset, table, field):
+    return offset + 100000 + table * FIELDS_PER_TABLE + field
+
+def make_card(offset, size, index, collection_id):
+    """ Une question MBQL avec jointures imbriquées, expressions, clauses field et référence card__ vers la précédente.
+    """
+    table = index % size
+    other = (index + 1) % size
+    f = lambda t, i: ["field", field_id(offset, t, i % FIELDS_PER_TABLE), {"base-type": "type/Integer"}]
+    source_table = f"card__{offset + 10000 + index - 1}" if index else offset + 1000 + table
+    query = {
+        "source-table" : source_table,
+        "joins" : [{
+            "alias" : f"J{index}",
+            "source-table" : offset + 1000 + other,
+            "condition" : ["=", f(table, 0), ["field", field_id(offset, other, 0), {"join-alias" : f"J{index}"}]],
+            "fields" : [ f(other, i) for i in range(3) ],
+        }],
+        "expressions" : { f"e{i}" : ["+", f(table, i), ["concat", "__PATTERN__", "x"]] for i in range(3) },
+        "breakout" : [ f(table, 1) ],
+        "filter" : ["and", [">", f(table, 2), 0], ["=", f(other, 3), "__PATTERN__"]],
+        "aggregation" : [["sum", f(table, 4)]],
+    }
+    return {
+        "id" : offset + 10000 + index,
+        "name" : f"card {index}",
+        "collection_id" : collection_id,
+        "database_id" : offset + 1,
+        "table_id" : offset + 1000 + table,
+        "created_at" : "2024-01-01",
+        "dataset_query" : { "database" : offset + 1, "type" : "query", "query" : query },
+        "result_metadata" : [ { "id" : field_id(offset, table, i), "name" : f"f{i}", "field_ref" : f(table, i) } for i in range(FIELDS_PER_TABLE) ],
+        "visualization_settings" : {},
+    }
+
+def make_dashboard(offset, size, index, collection_id):
+    cards = [ offset + 10000 + (index * 5 + i) % size for i in range(5) ]
+    return {
+        "id" : offset + 50000 + index,
+        "name" : f"dashboard {index}",
+        "collection_id" : collection_id,
+        "parameters" : [{ "id" : "p", "slug" : "p", "type" : "category" }],
+        "dashcards" : [{
+            "id" : offset + 60000 + index * 5 + i,
+            "card_id" : card_id,
+            "dashboard_tab_id" : None,
+            "parameter_mappings" : [{ "parameter_id" : "p", "card_id" : card_id, "target" : ["dimension", ["field", field_id(offset, i, 1), None]] }],
+            "visualization_settings" : {},
+        } for i, card_id in enumerate(cards) ],
+    }
+
+def make_structure(offset, size):
+    """ size tables de FIELDS_PER_TABLE champs, size/5 collections, size questions et size/5 dashboards.
+        offset décale tous les IDs pour distinguer la source de la cible.
+    """
+    tables = {}
+    for t in range(size) :
+        tables[offset + 1000 + t] = {
+            "name" : f"table {t}",
+            "details" : { "id" : offset + 1000 + t },
+            "fields" : { field_id(offset, t, i) : { "name" : f"f{i}", "details" : {} } for i in range(FIELDS_PER_TABLE) },
+        }
+
+    collections = {}
+    collections_count = max(1, size // 5)
+    for c in range(collections_count) :
+        collection_id = offset + 1 + c
+        location = "/" if c == 0 else f"/{offset + 1}/"
+        name = "🔒 bench" if c == 0 else f"collection {c}"
+        collections[collection_id] = { "name" : name, "details" : { "id" : collection_id, "name" : name, "location" : location }, "cards" : {}, "dashboards" : {} }
+
+    for index in range(size) :
+        collection_id = offset + 1 + index % collections_count
+        card = make_card(offset, size, index, collection_id)
+        collections[collection_id]["cards"][card["id"]] = { "name" : card["name"], "details" : card }
+
+    for index in range(collections_count) :
+        collection_id = offset + 1 + index % collections_count
+        dashboard = make_dashboard(offset, size, index, collection_id)
+        collections[collection_id]["dashboards"][str(dashboard["id"])] = { "name" : dashboard["name"], "details" : dashboard }
+
+    return {
+        "databases" : { offset + 1 : { "db_name" : DB_NAME, "details" : {}, "tables" : tables } },
+        "collections" : collections,
+    }
+
+def make_comparator(size, ledger_dir):
+    comparator = Comparator({ "__PATTERN__" : { "A" : "a", "B" : "b" } }, ledger_dir=ledger_dir)
+    comparator.add_instance(SyntheticInstance("A", make_structure(0, size)))
+    comparator.add_instance(SyntheticInstance("B", make_structure(1000000, size)))
+    return comparator
+
+
+def measure(func, repeat, number):
+    """ Meilleur temps moyen par appel sur repeat séries de number appels.
+    """
+    best = None
+    for _ in range(repeat) :
+        started = time.perf_counter()
+        for _ in range(number) : func()
+        elapsed = (time.perf_counter() - started) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def cold(comparator, convert):
+    """ convert sans modèle compilé en cache : mesure la compilation et le remplissage.
+    """
+    def func():
+        comparator.TEMPLATES.clear()
+        convert()
+    return func
+
+def run(sizes, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as ledger_dir :
+        for size in sizes :
+            comparator = make_comparator(size, ledger_dir)
+            collections = comparator.metabases_instances["A"]["collections"]
+            cards = [ card for c in collections.values() for card in c["cards"].values() ]
+            dashboards = [ dashboard for c in collections.values() for dashboard in c["dashboards"].values() ]
+            card, dashboard = cards[-1], dashboards[-1]
+            field = field_id(0, size - 1, FIELDS_PER_TABLE - 1)
+
+            convert_card = lambda: comparator.convert_card("A", card, "B")
+            convert_dashboard = lambda: comparator.convert_dashboard("A", dashboard, "B")
+            benchmarks = {
+                "convert_card_cold" : cold(comparator, convert_card),
+                "convert_card" : convert_card,
+                "get_field_id" : lambda: comparator.get_field_id("A", field, "B"),
+                "get_card_id" : lambda: comparator.get_card_id("A", card["details"]["id"], "B"),
+                "convert_dashboard_cold" : cold(comparator, convert_dashboard),
+                "convert_dashboard" : convert_dashboard,
+                "print_structures" : lambda: comparator.print_structures("A"),
+            }
+            for name, func in benchmarks.items() :
+                with contextlib.redirect_stdout(io.StringIO()) :
+                    elapsed = measure(func, repeat, 1 if name == "print_structures" else 20)
+                results[f"{name}[{size}]"] = elapsed
+                print(f"⏱️ {name}[{size}] : {elapsed*1000:.3f} ms")
+    return results
+
+def compare(baseline, current, threshold):
+    """ Retourne la liste des benchmarks plus lents de plus de threshold % que la référence.
+    """
+    regressions = []
+    for name, reference in baseline["results"].items() :
+        if name not in current["results"] : continue
+        delta = (current["results"][name] / reference - 1) * 100
+        status = "🔴" if delta > threshold else "🟢"
+        logger.info(f"{status} {name} : {reference*1000:.3f} ms --> {current['results'][name]*1000:.3f} ms ({delta:+.1f}%)")
+        if delta > threshold : regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de metabase-sync")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Lance les benchmarks et enregistre les résultats en JSON")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--out", default="_bench/current.json")
+
+    compare_parser = commands.add_parser("compare", help="Échoue si un benchmark est plus lent que la référence de plus de threshold %%")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=20)
+
+    args = parser.parse_args()
+
+    if args.command == "run" :
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+        results = run(args.sizes, args.repeat)
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump({ "python" : sys.version.split()[0], "sizes" : args.sizes, "results" : results }, f, indent=1)
+        print(f"Résultats enregistrés ici : {args.out}")
+        return 0
+
+    with open(args.baseline) as f: baseline = json.load(f)
+    with open(args.current) as f: current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions :
+        logger.error(f"{len(regressions)} régressions de plus de {args.threshold}% : {regressions}")
+        return 1
+    logger.info(f"Aucune régression de plus de {args.threshold}%")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,14 @@
-import requests, json, copy, traceback, re, os, sys, functools, time
+import requests, json, copy, traceback, re, os, sys, functools, time, csv
 from prettytable import PrettyTable
 from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+import threading
+
+try :
+    import ijson
+except ImportError :
+    ijson = None
 
 from loguru import logger
 logger.remove()
@@ -8,6 +16,32 @@ logger.add(sys.stderr, level="INFO")
 
 new_level = logger.level("FLAG", no=38, color="<yellow>", icon="🚩")
 
+
+class SyncError(Exception):
+    """ Erreur sur un objet à synchroniser. retryable : l'objet vaut-il d'être réessayé plus tard dans la même synchronisation ?
+    """
+    retryable = False
+
+class MissingDependencyError(SyncError):
+    """ L'objet dépend d'un autre (collection parente, question source...) pas encore présent dans la cible. """
+    retryable = True
+
+class EmptyDashboardError(SyncError):
+    """ Le dashboard importé est revenu vide ou incomplet. """
+    retryable = True
+
+class HTTPSyncError(SyncError):
+    """ L'API Metabase a refusé la requête, ou n'a pas répondu. Seules les erreurs serveur et réseau sont réessayées. """
+    def __init__(self, message, status_code=None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = status_code is None or status_code >= 500
+
+class UnresolvableIdError(SyncError):
+    """ Un ID (champ, table...) de la source n'a pas d'équivalent dans la cible. """
+    retryable = False
+
+
 def main()->None:
 
     logger.info(f"🤖 BONJOUR !")
@@ -17,7 +51,7 @@ def main()->None:
     DB_NAMES = SETTINGS.get("db_names")
     MANUAL_MAPPING = SETTINGS.get("patterns")
 
-    my_comparator = Comparator(MANUAL_MAPPING)
+    my_comparator = Comparator(MANUAL_MAPPING, lazy_schema=SETTINGS.get("lazy_schema", False))
 
     INSTANCES = {}
     for mb_name, mb_credentials in METABASE_INSTANCES.items():
@@ -28,6 +62,9 @@ def main()->None:
         INSTANCES[mb_name] = api
         my_comparator.add_instance(api)
     
+    if SETTINGS.get("targets") :
+        Scheduler(my_comparator, SETTINGS).run()
+
     #### ADD HERE YOUR LINES AS REQUIRED :
     #my_comparator.sync_collections_from_to("A", "B")
     #my_comparator.sync_collections_from_to("A", "C")
@@ -67,12 +104,58 @@ def load_json_from_file(filename):
         return {}
 
 
+class ThrottledSession(requests.Session):
+    """ Session dont chaque requête attend un jeton sur chacun des sémaphores de LIMITS (instance puis flotte).
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.LIMITS = []
+
+    def request(self, *args, **kwargs):
+        for limit in self.LIMITS : limit.acquire()
+        try :
+            return super().request(*args, **kwargs)
+        finally :
+            for limit in reversed(self.LIMITS) : limit.release()
+
+
+class Ledger():
+    """ Registre persistant des correspondances d'ID source --> cible, un fichier par instance cible.
+        Structure : { instance_source : { "collections"|"cards"|"dashboards" : { id_source : {"id": id_cible, "path": [...]} } } }
+    """
+    def __init__(self, name, ledger_dir="_ledger") -> None:
+        self.name = name
+        self.FILENAME = os.path.join(ledger_dir, f"{name}.json")
+        self.ENTRIES = ( os.path.exists(self.FILENAME) and load_json_from_file(self.FILENAME) ) or {}
+        self.need_save = False
+
+    def get(self, src_instance_name, kind, src_id):
+        return ( self.ENTRIES.get(src_instance_name) or {} ).get(kind, {}).get(str(src_id))
+
+    def record(self, src_instance_name, kind, src_id, trg_id, path):
+        entries = self.ENTRIES.setdefault(src_instance_name, {}).setdefault(kind, {})
+        entry = { "id" : int(trg_id), "path" : list(path) }
+        if entries.get(str(src_id)) != entry :
+            entries[str(src_id)] = entry
+            self.need_save = True
+
+    def save(self):
+        if not self.need_save : return
+        os.makedirs(os.path.dirname(self.FILENAME) or '.', exist_ok=True)
+        with open(self.FILENAME, 'w') as f:
+            json.dump(self.ENTRIES, f, ensure_ascii=False, indent=1)
+        self.need_save = False
+        logger.info(f"🤖[{self.name}] Registre des correspondances sauvegardé ici : {self.FILENAME}")
+
+
 class MetabaseAPI():
+    ENDPOINTS = { "collections" : "collection", "cards" : "card", "dashboards" : "dashboard" }
+
     def __init__(self, name, HOSTNAME, LOGIN, MDP, dbnames:list[str]) -> None:
         self.name = name
         self.DBNAMES = dbnames
         self.HOSTNAME = HOSTNAME
-        self.SESSION = requests.Session()
+        self.SESSION = ThrottledSession()
         self.SESSION.headers = {
             "Accept": "application/json",
             "Content-Type": "application/json",
@@ -88,16 +171,24 @@ class MetabaseAPI():
         self.get_version()
         self.get_databases()
 
-    def init_structure(self):
-        logger.info(f"🤖[{self.name}] Récupération de la structure ...")
+    def init_structure(self, lazy=False, table_names=None):
+        """ lazy=True : les champs ne sont récupérés que pour les tables utilisées par les cards et dashboards 🔒,
+            ou, si table_names est donné, pour les tables de ces noms ( {(nom de base, nom de table)} ).
+        """
+        logger.info(f"🤖[{self.name}] Récupération de la structure{' (mode paresseux)' if lazy else ''} ...")
         self.STRUCTURE = {"databases":{}}
 
         self.get_databases()        
         self.get_tables()
-        self.get_fields()
         self.get_collections()
         self.get_cards()
         self.get_dashboards()
+        if not lazy :
+            self.get_fields()
+        elif table_names is not None :
+            self.get_fields( self.get_table_ids_by_names(table_names) )
+        else :
+            self.get_referenced_fields()
         self.need_reload = False
 
         os.makedirs('_exports', exist_ok=True)
@@ -106,6 +197,13 @@ class MetabaseAPI():
 
         logger.info(f"🤖[{self.name}] Structure correctement initialisée et sauvegardée ici : _exports/{self.name}.json")
 
+    def set_request_limits(self, max_concurrency=None, budget=None):
+        """ Limite le nombre de requêtes simultanées vers l'instance, et les fait compter dans le budget global de la flotte.
+        """
+        self.SESSION.LIMITS = []
+        if max_concurrency : self.SESSION.LIMITS.append(threading.BoundedSemaphore(max_concurrency))
+        if budget : self.SESSION.LIMITS.append(budget)
+
     def get_version(self):
         try :
             self.PROPERTIES = self.SESSION.get(f"{self.HOSTNAME}/api/session/properties").json()
@@ -165,9 +263,12 @@ class MetabaseAPI():
         """
 
         self.STRUCTURE['collections'] = {}
-        _collections = self.SESSION.get(f"{self.HOSTNAME}/api/collection").json()
-        
-        self.COLLECTIONS = [ self.SESSION.get(f"{self.HOSTNAME}/api/collection/{c['id']}").json() for c in _collections ]
+
+        self.COLLECTIONS = []
+        for c in self.iter_list("/api/collection", ["id", "name", "location", "parent_id", "archived", "personal_owner_id"]) :
+            if c.get('parent_id') is None and c.get('location') :
+                c['parent_id'] = int(c['location'].strip('/').split('/')[-1] or 0) or None
+            self.COLLECTIONS.append(c)
         self.TO_BE_KEPT_COLLECTIONS_IDS = []
 
         for c in self.COLLECTIONS :
@@ -181,7 +282,7 @@ class MetabaseAPI():
                 "details" : c
             }
 
-    def import_collection(self, collection:dict)->None:
+    def import_collection(self, collection:dict)->int:
         """ Importer dans la nouvelle instance la collection passée en paramètre. Mise à jour si existe déjà.
         """
         collection_name = collection['name']
@@ -217,12 +318,12 @@ class MetabaseAPI():
 
                 self.need_reload = True
 
-            return self.SESSION
+            return new_id
         else : 
             
-            raise Exception(f"🟠 WARN - Importation de la collection '{collection_name}' - KO : {req.text}")
+            raise HTTPSyncError(f"🟠 WARN - Importation de la collection '{collection_name}' - KO : {req.text}", req.status_code)
 
-    def import_card( self, card:dict )->None:
+    def import_card( self, card:dict )->int:
         """ Importer une nouvelle question ou la mettre à jour.
         """
         card_name = card['name']
@@ -257,9 +358,39 @@ class MetabaseAPI():
 
             #if new_id and not new_id==existing_id :
             #    self.need_reload = True
-            return self.SESSION
+            self.register_entry("cards", req.json())
+            return new_id
         else : 
-            raise Exception(f"KO : {req.text}")        
+            raise HTTPSyncError(f"KO : {req.text}", req.status_code)
+
+    def register_entry(self, kind, obj:dict)->None:
+        """ Range (ou déplace) dans STRUCTURE une collection, card ou dashboard tel que renvoyé par l'API.
+        """
+        if kind == "collections" :
+            # On garde les cards et dashboards déjà rangés dans la collection
+            self.STRUCTURE['collections'].setdefault(obj['id'], {}).update({ "name" : obj['name'], "details" : obj })
+            return
+
+        key = str(obj['id']) if kind == "dashboards" else obj['id']
+        for collection in self.STRUCTURE['collections'].values() :
+            (collection.get(kind) or {}).pop(obj['id'], None)
+            (collection.get(kind) or {}).pop(str(obj['id']), None)
+
+        collection = self.STRUCTURE['collections'].get(obj.get('collection_id'))
+        if collection and not obj.get('archived') :
+            collection.setdefault(kind, {})[key] = { "name" : obj['name'], "details" : obj }
+
+    def fetch_entry(self, kind, object_id)->None:
+        """ Récupère à nouveau un seul objet de l'instance et met à jour STRUCTURE.
+        """
+        endpoint = self.ENDPOINTS[kind]
+        try :
+            req = self.SESSION.get(f"{self.HOSTNAME}/api/{endpoint}/{object_id}")
+            if req.status_code == 200 : return self.register_entry(kind, req.json())
+        except Exception as e :
+            logger.warning(f"🟠 WARN - Impossible de récupérer {kind}[{object_id}] de l'instance {self.name} : {e}")
+        else :
+            logger.debug(f"{kind}[{object_id}] introuvable dans l'instance {self.name} : {req.text}")
 
     def trouver_collections_dependantes(self, racine_id):
         collections_dependantes = []
@@ -273,13 +404,27 @@ class MetabaseAPI():
         parcourir_dependantes(racine_id)
         return [ racine_id ] + [ c['id'] for c in collections_dependantes ]
     
-    def get_cards(self) :
-        _cards = self.SESSION.get(f"{self.HOSTNAME}/api/card").json()
-        cards = [ self.SESSION.get(f"{self.HOSTNAME}/api/card/{c['id']}").json() for c in _cards ]
+    def iter_list(self, endpoint, fields:list[str]):
+        """ Parcourt une liste JSON de l'API au fil du téléchargement (ijson), en ne gardant que les champs demandés.
+            Sans ijson, la réponse est chargée en entier.
+        """
+        with self.SESSION.get(f"{self.HOSTNAME}{endpoint}", stream=True) as r :
+            # Une erreur (authentification, 5xx...) ne doit pas passer pour une instance vide
+            r.raise_for_status()
+            if ijson :
+                r.raw.decode_content = True
+                items = ijson.items(r.raw, 'item', use_float=True)
+            else :
+                items = r.json()
+            for item in items :
+                yield { key : item[key] for key in fields if key in item }
 
-        for c in cards :
-            _collection_id = c.get('collection_id')
+    def get_cards(self) :
+        # Seules les cards des collections gardées sont récupérées en détail, pendant le téléchargement de la liste.
+        for _card in self.iter_list("/api/card", ["id", "name", "collection_id"]) :
+            _collection_id = _card.get('collection_id')
             if _collection_id and self.STRUCTURE['collections'].get(_collection_id) :
+                c = self.SESSION.get(f"{self.HOSTNAME}/api/card/{_card['id']}").json()
                 if not self.STRUCTURE['collections'][_collection_id].get("cards") :
                     self.STRUCTURE['collections'][_collection_id]['cards'] = {}
                 self.STRUCTURE['collections'][_collection_id]['cards'][c['id']] = {
@@ -294,28 +439,34 @@ class MetabaseAPI():
         #print(f"Récupération des tables ...")
         databases_ids = self.STRUCTURE["databases"].keys()
         
-        self.TABLES = self.SESSION.get(f"{self.HOSTNAME}/api/table").json()
-        for t in self.TABLES :
+        self.TABLES = []
+        for t in self.iter_list("/api/table", ["id", "db_id", "name", "display_name", "schema", "entity_type", "active"]) :
             if t['db_id'] in databases_ids :
+                self.TABLES.append(t)
                 if not self.STRUCTURE["databases"][t['db_id']].get("tables") : self.STRUCTURE["databases"][t['db_id']]["tables"] = {}
                 self.STRUCTURE["databases"][t['db_id']]["tables"][t['id']] = {
                     "name" : t['display_name'],
                     "details" : t
                 }
     
-    def get_fields(self):
-
+    def get_fields(self, table_ids=None):
+        """ Récupération des champs de toutes les tables, ou seulement de table_ids.
+        """
         self.FIELDS = []
+        self.LOADED_TABLES_IDS = set()
+        self.add_fields(table_ids)
+
+    def add_fields(self, table_ids=None):
         for db_id in self.STRUCTURE["databases"].keys() :
             tables = self.STRUCTURE["databases"][db_id].get("tables") or {}
             for table_id in tables.keys() :
+                tables[table_id].setdefault('fields', {})
+                if table_id in self.LOADED_TABLES_IDS : continue
+                if table_ids is not None and table_id not in table_ids : continue
+                self.LOADED_TABLES_IDS.add(table_id)
                 metadata = self.SESSION.get(f"{self.HOSTNAME}/api/table/{table_id}/query_metadata?include_sensitive_fields=true").json()
                 fields = metadata.get('fields') or []
                 for field in fields :
-
-                    if not self.STRUCTURE["databases"][db_id]["tables"][table_id].get('fields') :
-                        self.STRUCTURE["databases"][db_id]["tables"][table_id]['fields']={}
-
                     self.STRUCTURE["databases"][db_id]["tables"][table_id]['fields'][field['id']] = {
                             "name": field['name'],
                             "details": field
@@ -323,6 +474,62 @@ class MetabaseAPI():
 
                     self.FIELDS.append(field)
 
+    def get_table_ids_by_names(self, table_names) -> set:
+        table_ids = set()
+        for db in self.STRUCTURE["databases"].values() :
+            for table_id, table in (db.get("tables") or {}).items() :
+                if (db['db_name'], table['name']) in table_names :
+                    table_ids.add(table_id)
+        return table_ids
+
+    @staticmethod
+    def collect_references(data, table_ids:set, field_ids:set):
+        """ Ajoute à table_ids et field_ids les IDs référencés par data : source-table, table_id, clauses field et clés field_id.
+        """
+        if isinstance(data, dict) :
+            for key, value in data.items() :
+                if isinstance(value, int) and not isinstance(value, bool) :
+                    if key in ['source-table', 'table_id'] : table_ids.add(value)
+                    elif 'field_id' in key or ( key == 'id' and 'field_ref' in data ) : field_ids.add(value)
+                else :
+                    MetabaseAPI.collect_references(value, table_ids, field_ids)
+        elif isinstance(data, list) :
+            if len(data) > 1 and data[0] == "field" and isinstance(data[1], int) :
+                field_ids.add(data[1])
+            for item in data :
+                if isinstance(item, (dict, list)) :
+                    MetabaseAPI.collect_references(item, table_ids, field_ids)
+
+    def get_referenced_fields(self):
+        """ Récupère les champs des seules tables référencées par les cards et dashboards des collections 🔒.
+            Les champs référencés hors de ces tables (jointures implicites...) font récupérer leur table via /api/field.
+        """
+        table_ids, field_ids = set(), set()
+        for collection in self.STRUCTURE['collections'].values() :
+            for kind in ["cards", "dashboards"] :
+                for obj in (collection.get(kind) or {}).values() :
+                    self.collect_references(obj['details'], table_ids, field_ids)
+
+        self.get_fields(table_ids)
+
+        loaded_fields_ids = { field['id'] for field in self.FIELDS }
+        missing_fields_ids = list(field_ids - loaded_fields_ids)
+        def fetch(field_id):
+            try :
+                req = self.SESSION.get(f"{self.HOSTNAME}/api/field/{field_id}")
+                req.raise_for_status()
+                return req.json()
+            except Exception as e :
+                logger.warning(f"🟠 WARN - Champ {field_id} référencé mais introuvable dans l'instance {self.name} : {e}")
+                return None
+
+        if missing_fields_ids :
+            with ThreadPoolExecutor(max_workers=8) as executor :
+                fields = [ field for field in executor.map(fetch, missing_fields_ids) if field ]
+            self.add_fields({ field.get('table_id') for field in fields } - {None})
+
+        logger.info(f"🤖[{self.name}] Champs récupérés pour {len(self.LOADED_TABLES_IDS)} tables référencées.")
+
     def get_dashboards(self):
 
         dashboards_ids = []
@@ -345,7 +552,7 @@ class MetabaseAPI():
                 "details" : dashboard
             }
 
-    def import_dashboard(self, dashboard:dict)->None:
+    def import_dashboard(self, dashboard:dict)->int:
         """ Importer une nouvelle question ou la mettre à jour.
         """
         dashboard_name = dashboard['name']
@@ -364,8 +571,8 @@ class MetabaseAPI():
         if dashboard.get('updated_at') : dashboard.pop('updated_at')
 
         if dashboard.get('tabs') :
-            for tab in dashboard['tabs'] :
-                tab.pop('entity_id')
+            # Copie des onglets : le dashboard converti partage ses sous-objets avec le modèle (PayloadTemplate)
+            dashboard['tabs'] = [ { k : v for k, v in tab.items() if k != 'entity_id' } for tab in dashboard['tabs'] ]
 
         for label in ['param_values', 'entity_id', 'last-edit-info'] :
             if dashboard.get(label):
@@ -385,12 +592,7 @@ class MetabaseAPI():
         if req.status_code == 200 : 
 
             new_id = req.json().get('id') 
-            fresh_dashboard = self.SESSION.get(f"{self.HOSTNAME}/api/dashboard/{new_id}").json()
-            
-            # Vérification : 
-            if len( fresh_dashboard.get('dashcards') or [] ) == 0 :
-                logger.warning(f"🟠 WARN - KO EMPTY - Le dashboard récemment ajouté ({new_id}) est vide !")
-                raise Exception(f"🟠 WARN - Importation du dashboard '{dashboard_name}' - KO EMPTY : {req.text}") 
+            # La vérification du contenu (dashcards) est faite après coup, pour tous les dashboards : voir verify_dashboards
 
             if existing_id:
                 logger.info(f"🟢 Mise à jour du dashboard '{dashboard_name}' (ID {dashboard.get('old_id')}-->{new_id}): {URL}")
@@ -414,17 +616,86 @@ class MetabaseAPI():
             #    logger.info(f"Ajout de la carte {_card.get('card_id')} : {card}")
             #    logger.info(f"{req}")
 
+            return new_id
+         
+        raise HTTPSyncError(f"🟠 WARN - Importation du dashboard '{dashboard_name}' - KO : {req.text}", req.status_code)
+
+    def verify_dashboards(self, expected_dashcards:dict, max_workers=8)->list:
+        """ Récupère en parallèle les dashboards passés en paramètre ({id: nombre de dashcards attendu}),
+            met à jour leur entrée dans STRUCTURE et retourne les IDs des dashboards vides ou incomplets.
+        """
+        def fetch(dashboard_id):
+            try :
+                req = self.SESSION.get(f"{self.HOSTNAME}/api/dashboard/{dashboard_id}")
+                req.raise_for_status()
+                return req.json()
+            except Exception as e :
+                logger.warning(f"🟠 WARN - Vérification du dashboard {dashboard_id} de l'instance {self.name} impossible : {e}")
+                return None
+
+        ids = list(expected_dashcards.keys())
+        with ThreadPoolExecutor(max_workers=max_workers) as executor :
+            fresh_dashboards = list(executor.map(fetch, ids))
+
+        failed = []
+        for dashboard_id, fresh_dashboard in zip(ids, fresh_dashboards) :
+            if fresh_dashboard is None :
+                failed.append(dashboard_id)
+                continue
+
+            for collection in self.STRUCTURE['collections'].values() :
+                (collection.get('dashboards') or {}).pop(str(dashboard_id), None)
+                (collection.get('dashboards') or {}).pop(dashboard_id, None)
+
             fresh_dashboard_collection_id = fresh_dashboard.get("collection_id")
-            if fresh_dashboard_collection_id :
-                self.STRUCTURE['collections'][fresh_dashboard_collection_id]['dashboards'][new_id] = {
-                "name" : fresh_dashboard['name'],
-                "details" : fresh_dashboard
-            }
+            if self.STRUCTURE['collections'].get(fresh_dashboard_collection_id) :
+                self.STRUCTURE['collections'][fresh_dashboard_collection_id].setdefault('dashboards', {})[str(dashboard_id)] = {
+                    "name" : fresh_dashboard.get('name'),
+                    "details" : fresh_dashboard
+                }
 
-            return self.SESSION
-         
-        raise Exception(f"🟠 WARN - Importation du dashboard '{dashboard_name}' - KO : {req.text}")     
+            dashcards_count = len( fresh_dashboard.get('dashcards') or [] )
+            if dashcards_count < expected_dashcards[dashboard_id] :
+                logger.warning(f"🟠 WARN - KO EMPTY - Le dashboard {dashboard_id} de l'instance {self.name} a {dashcards_count} cartes au lieu de {expected_dashcards[dashboard_id]} !")
+                failed.append(dashboard_id)
+
+        logger.info(f"🤖[{self.name}] {len(ids)-len(failed)} dashboards vérifiés sur {len(ids)}")
+        return failed
         
+    def archive_objects(self, kind, ids, batch_size=20)->list:
+        """ Archive les collections, cards ou dashboards passés en paramètre, par lots de requêtes parallèles.
+            Retourne la liste des IDs effectivement archivés.
+        """
+        endpoint = self.ENDPOINTS[kind]
+
+        def archive(object_id):
+            try :
+                req = self.SESSION.put(f"{self.HOSTNAME}/api/{endpoint}/{object_id}", json={"archived" : True})
+            except Exception as e :
+                logger.warning(f"🟠 WARN - Archivage {kind}[{object_id}] sur l'instance {self.name} - KO : {e}")
+                return None
+            if req.status_code == 200 :
+                logger.info(f"🗑️ Archivage {kind}[{object_id}] sur l'instance {self.name} - OK")
+                return object_id
+            logger.warning(f"🟠 WARN - Archivage {kind}[{object_id}] sur l'instance {self.name} - KO : {req.text}")
+            return None
+
+        archived = []
+        ids = list(ids)
+        with ThreadPoolExecutor(max_workers=batch_size) as executor :
+            for start in range(0, len(ids), batch_size) :
+                archived = archived + [ i for i in executor.map(archive, ids[start:start+batch_size]) if i is not None ]
+
+        for object_id in archived :
+            if kind == "collections" :
+                self.STRUCTURE['collections'].pop(object_id, None)
+                continue
+            for collection in self.STRUCTURE['collections'].values() :
+                (collection.get(kind) or {}).pop(object_id, None)
+                (collection.get(kind) or {}).pop(str(object_id), None)
+
+        return archived
+
     def reset_all_databases_caches(self):
         logger.info(f"Reset du cache de Metabase de l'instance {self.name}")
         for db_id in self.STRUCTURE['databases'].keys():
@@ -442,10 +713,141 @@ class MetabaseAPI():
             else:
                 logger.warning(f"🟠 WARN - DB[{db_id}] - {OPERATION} - ERROR : {req.text()}")
 
+class PayloadTemplate():
+    """ Card ou dashboard source compilé une seule fois : le contenu d'origine, jamais modifié, et la liste des emplacements
+        (chemin, action, valeur) des IDs à traduire et des chaînes contenant un motif.
+    """
+    def __init__(self, payload:dict, patterns) -> None:
+        self.PAYLOAD = payload
+        self.PATTERNS = list(patterns or [])
+        self.SLOTS = []
+        self.compile(payload, ())
+
+    def compile(self, data, path):
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if key == 'id' and isinstance(value, int):
+                    if "field_ref" in data :
+                        self.SLOTS.append( (path + (key,), "field_ref", value) )
+
+                elif key in ['created_at','updated_at'] :
+                    self.SLOTS.append( (path + (key,), "null", None) )
+
+                elif "id" in key or 'source-' in key or key in ['database'] :
+                    if key=="source-table" and isinstance(value, str) and "card__" in value :
+                        self.SLOTS.append( (path + (key,), "card__", value) )
+                    elif not isinstance(value, int|str) :
+                        continue
+                    else :
+                        for kind in ["database", "table", "field", "collection", "card"] :
+                            if kind in key :
+                                self.SLOTS.append( (path + (key,), kind, value) )
+                                break
+                else :
+                    self.compile(value, path + (key,))
+
+        elif isinstance(data, list) and len(data)>1 and data[0] == "field" and isinstance(data[1], int) :
+            self.SLOTS.append( (path + (1,), "field_clause", data[1]) )
+            for idx, v in enumerate(data) :
+                if isinstance(v, dict) or isinstance(v, list) :
+                    self.compile(v, path + (idx,))
+
+        elif isinstance(data, list):
+            for idx, item in enumerate(data):
+                if isinstance(item, str) and any( pattern in item for pattern in self.PATTERNS ) :
+                    self.SLOTS.append( (path + (idx,), "pattern", item) )
+                else :
+                    self.compile(item, path + (idx,))
+
+    def fill(self, resolve):
+        """ Retourne une copie du contenu où chaque emplacement vaut resolve(action, valeur), ou reste inchangé si resolve
+            renvoie ... (Ellipsis). Seuls les conteneurs sur le chemin d'un emplacement sont copiés, le reste est partagé.
+        """
+        root = copy.copy(self.PAYLOAD)
+        copied = { () : root }
+        for path, action, value in self.SLOTS :
+            new_value = resolve(action, value)
+            if new_value is ... : continue
+
+            container = root
+            for depth in range(len(path) - 1) :
+                prefix = path[:depth+1]
+                if prefix not in copied :
+                    copied[prefix] = copy.copy(container[path[depth]])
+                    container[path[depth]] = copied[prefix]
+                container = copied[prefix]
+            container[path[-1]] = new_value
+        return root
+
+
 class Comparator():
-    def __init__(self, MANUAL_MAPPING) -> None:
+    def __init__(self, MANUAL_MAPPING, ledger_dir="_ledger", lazy_schema=False) -> None:
         self.metabases_instances = {}
         self.MANUAL_MAPPING=MANUAL_MAPPING
+        self.LAZY_SCHEMA = lazy_schema
+        self.TEMPLATES = {}
+        self.RESOLVED_IDS = {}
+        self.LEDGER_DIR = ledger_dir
+        self.LEDGERS = {}
+
+    def get_ledger(self, trg_database_name) -> Ledger:
+        if not self.LEDGERS.get(trg_database_name) :
+            self.LEDGERS[trg_database_name] = Ledger(trg_database_name, ledger_dir=self.LEDGER_DIR)
+        return self.LEDGERS[trg_database_name]
+
+    def get_collection_path(self, database_name, collection_id) -> tuple:
+        """ Retourne le chemin (noms des collections depuis la racine 🔒) de la collection dans l'instance.
+        """
+        collections = self.metabases_instances[database_name]["collections"]
+        path = []
+        while collection_id and collections.get(collection_id) and len(path) <= len(collections) :
+            collection = collections[collection_id]
+            path.insert(0, collection['name'])
+            details = collection.get('details') or {}
+            collection_id = details.get('parent_id')
+            if collection_id is None and details.get('location') :
+                collection_id = int(details['location'].strip('/').split('/')[-1] or 0) or None
+        return tuple(path)
+
+    def find_in_collections(self, database_name, kind, object_id):
+        """ Retourne (collection_id, objet) pour une card ou un dashboard de l'instance, ou (None, None).
+        """
+        for collection_id, collection in self.metabases_instances[database_name]["collections"].items():
+            objects = collection.get(kind) or {}
+            found = objects.get(object_id) or objects.get(str(object_id)) or ( str(object_id).isdigit() and objects.get(int(object_id)) )
+            if found : return collection_id, found
+        return None, None
+
+    def get_ledger_id(self, src_database_name, kind, src_id, trg_database_name):
+        """ Retourne l'ID cible mémorisé dans le registre, s'il est présent dans la structure actuelle de la cible.
+            Sinon l'entrée est ignorée mais gardée : une récupération incomplète de la cible ne doit pas vider le registre.
+        """
+        ledger = self.get_ledger(trg_database_name)
+        entry = ledger.get(src_database_name, kind, src_id)
+        if not entry : return None
+
+        trg_id = entry['id']
+        if kind == "collections" :
+            exists = self.metabases_instances[trg_database_name]["collections"].get(trg_id)
+        else :
+            exists = self.find_in_collections(trg_database_name, kind, trg_id)[1]
+
+        if exists : return trg_id
+
+        logger.debug(f"Registre {trg_database_name} : {kind}[{src_id}]-->{trg_id} absent de la structure de la cible, on l'ignore.")
+        return None
+
+    def record_import(self, src_database_name, kind, src_id, trg_database_name, trg_id):
+        """ Mémorise dans le registre de la cible la correspondance établie par un import réussi.
+        """
+        if not trg_id : return
+        if kind == "collections" :
+            path = self.get_collection_path(src_database_name, src_id)
+        else :
+            collection_id, src_object = self.find_in_collections(src_database_name, kind, src_id)
+            if not src_object : return
+            path = self.get_collection_path(src_database_name, collection_id) + ( src_object['name'], )
+        self.get_ledger(trg_database_name).record(src_database_name, kind, src_id, trg_id, path)
 
     def add_instance(self, instance:MetabaseAPI):
         self.metabases_instances[instance.name] = instance.STRUCTURE
@@ -454,13 +856,32 @@ class Comparator():
         if len(self.metabases_instances.keys())>1 :
             self.check_versions()
 
-    def refresh_instance(self, instance_name):
+    def refresh_instance(self, instance_name, table_names=None):
         instance = self.metabases_instances[instance_name]['instance']
-        instance.init_structure()
+        instance.init_structure(lazy=self.LAZY_SCHEMA, table_names=table_names)
+
+        # Les modèles compilés et les correspondances de schéma de cette instance sont à refaire
+        self.TEMPLATES = { key : template for key, template in list(self.TEMPLATES.items()) if key[0] != instance_name }
+        self.RESOLVED_IDS = { key : new_id for key, new_id in list(self.RESOLVED_IDS.items()) if instance_name not in (key[0], key[3]) }
 
         self.metabases_instances[instance.name] = instance.STRUCTURE
         self.metabases_instances[instance.name]['instance'] = instance
 
+    def refresh_instances(self, src_database_name, trg_database_name, refresh_source=True):
+        """ Rafraîchit la source puis la cible. En mode paresseux, la cible ne charge que les tables chargées dans la source.
+        """
+        if refresh_source :
+            self.refresh_instance(src_database_name)
+        table_names = None
+        if self.LAZY_SCHEMA :
+            src_instance = self.metabases_instances[src_database_name]['instance']
+            table_names = set()
+            for db in self.metabases_instances[src_database_name]['databases'].values() :
+                for table_id, table in (db.get('tables') or {}).items() :
+                    if table_id in src_instance.LOADED_TABLES_IDS :
+                        table_names.add( (db['db_name'], table['name']) )
+        self.refresh_instance(trg_database_name, table_names=table_names)
+
     def check_versions(self):
         versions = {}
         for instance_name, instance_object in self.metabases_instances.items() :
@@ -472,18 +893,17 @@ class Comparator():
         logger.info(f"Toutes les versions sont bien identiques : {versions}")
 
     def clear_cache(self):
+        """ Vide les caches des recherches d'ID. RESOLVED_IDS (schéma) n'est invalidé que par refresh_instance, pour la seule instance rafraîchie.
+        """
         logger.info(f"clear_cache...")
-        self.get_database_id.cache_clear() 
-        self.get_table_id.cache_clear() 
-        self.get_field_id.cache_clear() 
-        self.get_collection_id.cache_clear() 
-        self.get_dashboard_id.cache_clear() 
-        self.get_card_id.cache_clear()
+        for lookup in [ self.get_database_id, self.get_table_id, self.get_field_id, self.get_collection_id, self.get_dashboard_id, self.get_card_id ] :
+            if hasattr(lookup, "cache_clear") : lookup.cache_clear()
 
     def reload_if_needed(self, database_name):
         if self.metabases_instances[database_name]['instance'].need_reload :
             #self.metabases_instances[database_name]['instance'].reload_if_needed()
             self.clear_cache()
+            self.metabases_instances[database_name]['instance'].need_reload = False
 
     def get_database_id(self, src_database_name, src_database_id, trg_database_name ) :
         src_db_name = self.metabases_instances[src_database_name]["databases"][src_database_id]['db_name']
@@ -538,14 +958,20 @@ class Comparator():
         src_collection = self.metabases_instances[src_database_name]["collections"].get(src_collection_id)
         if not src_collection : return None
 
-        src_collection_name = src_collection['name']
+        ledger_id = self.get_ledger_id(src_database_name, "collections", src_collection_id, trg_database_name)
+        if ledger_id : return ledger_id
+
+        src_collection_path = self.get_collection_path(src_database_name, src_collection_id)
 
         for collection_id in self.metabases_instances[trg_database_name]['collections'].keys():
-            if self.metabases_instances[trg_database_name]['collections'][collection_id]['name'] == src_collection_name :
+            if self.get_collection_path(trg_database_name, collection_id) == src_collection_path :
                 return collection_id
         return None
 
     def get_dashboard_id(self, src_database_name, src_dashboard_id, trg_database_name):
+        ledger_id = self.get_ledger_id(src_database_name, "dashboards", src_dashboard_id, trg_database_name)
+        if ledger_id : return ledger_id
+
         ## Récupération du dashboard de base dans la base de données source
         src_dashboard = None
         src_dashboard_id = str(src_dashboard_id)
@@ -578,6 +1004,9 @@ class Comparator():
             Retourne l'ID correspondant à la carte mais dans la base de donnée cible.
         """
 
+        ledger_id = self.get_ledger_id(src_database_name, "cards", src_card_id, trg_database_name)
+        if ledger_id : return ledger_id
+
         ## Récupération de la carte de base dans la base de données source
         src_card = None
         src_card_id = str(src_card_id)
@@ -605,111 +1034,72 @@ class Comparator():
             if cards[card_id]['name'] == src_card['name'] :
                 return card_id
 
+    def get_template(self, src_database_name, kind, data) -> PayloadTemplate:
+        """ Modèle compilé (une seule fois par structure source) de la card ou du dashboard.
+        """
+        payload = data.get('details') or data
+        key = (src_database_name, kind, str(payload['id']))
+        template = self.TEMPLATES.get(key)
+        if not template or template.PAYLOAD is not payload :
+            template = self.TEMPLATES[key] = PayloadTemplate(payload, (self.MANUAL_MAPPING or {}).keys())
+        return template
+
+    def apply_patterns(self, item, trg_database_name):
+        new_item = item
+        for pattern, values in (self.MANUAL_MAPPING or {}).items() :
+            if pattern in new_item :
+                new_item = new_item.replace(pattern, values[trg_database_name])
+        logger.info(f"🫑 remplacement de {item} par {new_item}")
+        return new_item
+
+    def resolve_id(self, src_database_name, action, value, trg_database_name):
+        """ Valeur d'un emplacement de PayloadTemplate pour la cible. ... laisse la valeur source.
+            Les correspondances de schéma (base, table, champ) sont mémorisées jusqu'au prochain rafraîchissement.
+        """
+        if action == "null" : return None
+        if action == "pattern" : return self.apply_patterns(value, trg_database_name)
+
+        if action == "card__" :
+            new_id = self.get_card_id(src_database_name, value.split('__')[-1], trg_database_name)
+            if not new_id :
+                raise MissingDependencyError(f"MISSING-TABLE - Cette question dépend d'une table inconnue ({value})")
+            return f"card__{new_id}"
+
+        kind = "field" if action in ["field_ref", "field_clause"] else action
+        key = (src_database_name, kind, value, trg_database_name)
+        # get() plutôt que in + [] : refresh_instance peut remplacer le dictionnaire depuis un autre thread du Scheduler
+        new_id = self.RESOLVED_IDS.get(key, ...)
+        if new_id is ... :
+            get_id = { "database" : self.get_database_id, "table" : self.get_table_id, "field" : self.get_field_id,
+                       "collection" : self.get_collection_id, "card" : self.get_card_id }[kind]
+            new_id = get_id(src_database_name, value, trg_database_name)
+            if new_id is not None and kind in ["database", "table", "field"] :
+                self.RESOLVED_IDS[key] = new_id
+
+        if action == "field_clause" and new_id is None :
+            raise UnresolvableIdError(f"Le champ {value} de {src_database_name} n'a pas d'équivalent dans {trg_database_name}")
+        if action == "field_ref" : return new_id
+        return ... if new_id is None else new_id
+
     def convert_card(self, src_database_name, data, trg_database_name):
-        _data = copy.copy(data)
-        if _data.get('details') : _data=_data['details']
+        template = self.get_template(src_database_name, "cards", data)
+        _data = template.fill( partial(self.resolve_id, src_database_name, trg_database_name=trg_database_name) )
         if _data['id'] : 
             _data['old_id'] = _data['id']
             _data['id']=self.get_card_id(src_database_name,_data['id'], trg_database_name)
-        self._convert_card(src_database_name, _data, trg_database_name)
         return _data
     
     def convert_dashboard(self, src_database_name, data, trg_database_name):
-        _data = copy.copy(data)
-        if _data.get('details') : _data=_data['details']
+        template = self.get_template(src_database_name, "dashboards", data)
+        _data = template.fill( partial(self.resolve_id, src_database_name, trg_database_name=trg_database_name) )
         if _data['id'] : 
             _data['old_id'] = _data['id']
             _data['id']=self.get_dashboard_id(src_database_name,_data['id'], trg_database_name)
-        self._convert_card(src_database_name, _data, trg_database_name)
         return _data        
 
-    def _convert_card(self, src_database_name, data, trg_database_name):
-        """ Change les champs du card passé en paramètre pour s'adapter à la prochaine instance MB.
-        """
-        convert_database_id = partial(self.get_database_id, src_database_name, trg_database_name=trg_database_name)
-        convert_table_id = partial(self.get_table_id, src_database_name, trg_database_name=trg_database_name)
-        convert_field_id = partial(self.get_field_id, src_database_name, trg_database_name=trg_database_name)
-        convert_collection_id = partial(self.get_collection_id, src_database_name, trg_database_name=trg_database_name)
-        convert_card_id = partial(self.get_card_id, src_database_name, trg_database_name=trg_database_name)
-
-        if isinstance(data, dict):
-            for key, value in list(data.items()):
-
-                # Gérer les cas des ID seuls
-                if key == 'id' and isinstance(value, int):
-                    if "field_ref" in list(data.keys()) :
-                        data[key] = convert_field_id(value)
-                else:
-                    # Traitement général pour d'autres IDs
-
-                    if key in ['created_at','updated_at'] :
-                        data[key] = None
-
-                    elif (    "id" in key or 
-                            'source-' in key or 
-                            key in ['database'] ):  # Si la clé contient 'id', déterminer le type et remplacer
-                        
-                        new_id = None
-
-                        
-                        if key=="source-table" and isinstance(value, str) and "card__" in value :
-                            old_card_id = value.split('__')[-1]
-                            new_int_id = convert_card_id(old_card_id)
-                            if not new_int_id : 
-                                raise Exception(f"MISSING-TABLE - Cette question dépend d'une table inconnue ({value})") 
-                            new_id = f"card__{ convert_card_id(old_card_id) }"
-                        
-                        elif not isinstance(value, int|str):
-                            #print(f"On essaie de transformer un truc bizarre --> {key}:{value}, on le laisse comme ça.")
-                            new_id = value
-                        elif "database" in key:
-                            new_id = convert_database_id(value)
-                        elif "table" in key:
-                            new_id = convert_table_id(value)
-                        elif "field" in key:
-                            new_id = convert_field_id(value)
-                        elif "collection" in key:
-                            new_id = convert_collection_id(value)
-                        elif "card" in key:
-                            new_id = convert_card_id(value)
-
-                        if new_id is not None:
-                            data[key] = new_id  # Mettre à jour l'ID
-                    else:
-                        # Recursivement remplacer les ids dans les sous-dictionnaires ou les listes
-                        self._convert_card(src_database_name, value, trg_database_name)
-
-        elif isinstance(data, list) and len(data)>1 and data[0] == "field" and isinstance(data[1], int) :
-            field_id = data[1]
-            new_id = convert_field_id(field_id)  # Obtenir le nouvel ID du champ
-            data[1] = new_id  # Mettre à jour l'ID dans la liste
-
-            for v in data :
-                if isinstance(v, dict) or isinstance(v, list) :
-                    self._convert_card(src_database_name, v, trg_database_name)
-
-        elif isinstance(data, list):
-            for idx, item in enumerate(data):
-
-                if isinstance(item,str) and any( [ pattern in item for pattern in self.MANUAL_MAPPING.keys() ] ) :
-                    
-                    for pattern in self.MANUAL_MAPPING.keys() :
-                        if pattern in item :
-                            new_item = item.replace(pattern, self.MANUAL_MAPPING[pattern][trg_database_name])
-                            data[idx] = new_item
-                            logger.info(f"🫑 remplacement de {item} par {new_item}")
-                            continue
-
-                    #new_value =  self.MANUAL_MAPPING[item].get(trg_database_name)
-                    #data[idx] = new_value or data[idx]
-                    #continue
-                
-                self._convert_card(src_database_name, item, trg_database_name)
-
     def convert_collection(self, src_database_name, data, trg_database_name):
 
-        _data = copy.copy(data)
-        if _data.get('details') : _data=_data['details']
+        _data = copy.deepcopy(data.get('details') or data)
 
         _old_id = _data['id']
         if not _old_id : logger.warning(f"Cette collection n'a pas d'ID ?! : {data}")
@@ -718,7 +1108,7 @@ class Comparator():
         _new_parent_id = self.get_collection_id(src_database_name, _old_parent_id, trg_database_name)
 
         if _old_parent_id and not _new_parent_id :
-                raise Exception(f"On ne peut pas migrer cette collection ({_data['name']}[{_old_id}]) car on n'a pas sa collection parente ({_old_parent_id}).")
+                raise MissingDependencyError(f"On ne peut pas migrer cette collection ({_data['name']}[{_old_id}]) car on n'a pas sa collection parente ({_old_parent_id}).")
 
         _data['id'] = _new_id
         _data['old_id'] = _old_id
@@ -730,150 +1120,482 @@ class Comparator():
         logger.debug(f"convert_collection(old={_data['old_id']}, new={_data['id']}, old_parent_id={_data['old_parent_id']}, new_parent_id={_data.get('parent_id')})")
         return _data
 
-    def sync_collections_from_to(self, src_database_name, trg_database_name):
+    def sync_object(self, src_database_name, trg_database_name, kind, src_id):
+        """ Convertit et importe dans la cible une collection, card ou dashboard de la source.
+            Retourne l'ID cible et l'objet converti.
+        """
+        trg_instance = self.metabases_instances[trg_database_name]['instance']
+
+        if kind == "collections" :
+            converted = self.convert_collection(src_database_name, self.metabases_instances[src_database_name]['collections'][src_id], trg_database_name)
+            new_id = trg_instance.import_collection(converted)
+        elif kind == "cards" :
+            converted = self.convert_card(src_database_name, self.find_in_collections(src_database_name, kind, src_id)[1], trg_database_name)
+            new_id = trg_instance.import_card(converted)
+        else :
+            converted = self.convert_dashboard(src_database_name, self.find_in_collections(src_database_name, kind, src_id)[1], trg_database_name)
+            new_id = trg_instance.import_dashboard(converted)
+            self.reload_if_needed(trg_database_name)
+
+        self.record_import(src_database_name, kind, src_id, trg_database_name, new_id)
+        return new_id, converted
+
+    @staticmethod
+    def collect_card_references(data, card_ids:set):
+        """ Ajoute à card_ids les IDs des questions référencées par data (card__X, card_id).
+        """
+        if isinstance(data, dict) :
+            for key, value in data.items() :
+                if key == 'card_id' and isinstance(value, int) : card_ids.add(value)
+                elif isinstance(value, str) and value.startswith("card__") : card_ids.add(value.split('__')[-1])
+                else : Comparator.collect_card_references(value, card_ids)
+        elif isinstance(data, list) :
+            for item in data :
+                Comparator.collect_card_references(item, card_ids)
+
+    def failed_card_dependency(self, src_database_name, src_id, failed:dict):
+        """ ID d'une question dont dépend la question src_id et qui est en échec définitif dans failed, sinon None.
+        """
+        card_ids = set()
+        self.collect_card_references((self.find_in_collections(src_database_name, "cards", src_id)[1] or {}).get('details'), card_ids)
+        for card_id in card_ids :
+            error = failed.get( ("cards", int(card_id)) ) if str(card_id).isdigit() else None
+            if error is not None and not getattr(error, "retryable", False) : return int(card_id)
+        return None
 
-        first_try = True
-        need_retry = False
-        dashboard_is_empty = 0
-        
-        while first_try or need_retry :
-            first_try = False
-            if need_retry :
-                logger.info(f"🤖 A priori, ça vaut le coup de réessayer. Alors go !")
-            
-            self.refresh_instance(trg_database_name)
-            self.refresh_instance(src_database_name)
+    def refetch_target_entries(self, src_database_name, trg_database_name, queue):
+        """ Avant un nouvel essai, ne récupère dans la cible que les objets dont ont besoin ceux de la file :
+            eux-mêmes, leur collection et les questions dont ils dépendent, d'après le registre.
+        """
+        ledger = self.get_ledger(trg_database_name)
+        needed = set()
+        for kind, src_id in queue :
+            if kind == "collections" :
+                collection_id, src_object = src_id, self.metabases_instances[src_database_name]['collections'].get(src_id)
+            else :
+                collection_id, src_object = self.find_in_collections(src_database_name, kind, src_id)
+                card_ids = set()
+                self.collect_card_references((src_object or {}).get('details'), card_ids)
+                needed.update( ("cards", card_id) for card_id in card_ids )
+                needed.add( (kind, src_id) )
+            needed.add( ("collections", collection_id) )
+            parent_id = ((src_object or {}).get('details') or {}).get('parent_id') if kind == "collections" else None
+            if parent_id : needed.add( ("collections", parent_id) )
+
+        trg_instance = self.metabases_instances[trg_database_name]['instance']
+        for kind, src_id in needed :
+            entry = ledger.get(src_database_name, kind, src_id)
+            if entry : trg_instance.fetch_entry(kind, entry['id'])
+
+    def sync_collections_from_to(self, src_database_name, trg_database_name, refresh_source=True, max_retry_attempts=3) -> dict:
+        """ Synchronise les collections 🔒 de la source vers la cible. Retourne, par type d'objet, [migrés, total, échecs réessayables].
+            refresh_source=False permet de réutiliser une structure source déjà récupérée (plusieurs cibles).
+            Seuls les objets en échec réessayable (SyncError.retryable) sont réessayés, au plus max_retry_attempts fois.
+        """
+        self.refresh_instances(src_database_name, trg_database_name, refresh_source)
 
-            need_retry = False
+        src_collections = self.metabases_instances[src_database_name]['collections']
+        queue = [ ("collections", collection_id) for collection_id in src_collections.keys() ]
+        for kind in ["cards", "dashboards"] :
+            queue = queue + [ (kind, object_id) for collection in src_collections.values() for object_id in (collection.get(kind) or {}).keys() ]
 
-            cards_count = dashboards_count = collections_count = 0
+        counts = { kind : len([ item for item in queue if item[0] == kind ]) for kind in ["collections", "cards", "dashboards"] }
+        failed = {}
 
-            collections = self.metabases_instances[src_database_name]['collections'].items()
-            collections_count = len(collections)
-            cards_migrated_count = dashboards_migrated_count = collections_migrated_count = 0
+        for attempt in range(max_retry_attempts + 1) :
+            if attempt :
+                logger.info(f"🤖 Nouvel essai ({attempt}/{max_retry_attempts}) pour {len(queue)} objets en échec. Alors go !")
+                self.refetch_target_entries(src_database_name, trg_database_name, queue)
 
-            for collection_id, collection in collections :
-                try :
-                    collection = self.convert_collection(src_database_name, collection, trg_database_name)
-                    self.metabases_instances[trg_database_name]['instance'].import_collection(collection)
-                    collections_migrated_count = collections_migrated_count+1
-                
-                except Exception as e :
-                    if not "MISSING-TABLE" in str(e) :
-                        logger.debug(f"Avant conversion : collection={collection}")
-                    else :
-                        need_retry = True
-                    logger.warning(f"🟠 WARN - Problème sur la collection {collection_id} de la base {src_database_name} : {e}")
-                    continue
-                
-                cards = self.metabases_instances[src_database_name]['collections'][collection_id].get('cards') or {}
-                cards_count = cards_count + len(cards)
-                
-                for card_id, card in cards.items() :
-                    try :
-                        card = self.convert_card(src_database_name, card, trg_database_name)
-                        self.metabases_instances[trg_database_name]['instance'].import_card(card)
-                        cards_migrated_count = cards_migrated_count + 1
-                    except Exception as e :
-                        if not "MISSING-TABLE" in str(e) :
-                            logger.debug(f"DEBUG : avant conversion : card={card}")
-                            logger.debug(traceback.format_exc())
-                        else :
-                            need_retry = True                            
-                        logger.warning(f"🟠 WARN - Impossible de migrer la question {card_id} : {e}")
-                        #break
-                        continue
+            retry_queue = []
+            imported_dashboards = {}
+            imported_dashboards_src_ids = {}
 
-            for collection_id, collection in self.metabases_instances[src_database_name]['collections'].items() : 
-                dashboards = self.metabases_instances[src_database_name]['collections'][collection_id].get('dashboards') or {}
-                
-                dashboards_count = dashboards_count + len(dashboards.items())
-                
-                for dashboard_id, dashboard in dashboards.items() :
+            try :
+                for kind, src_id in queue :
                     try :
-                        dashboard = self.convert_dashboard(src_database_name, dashboard, trg_database_name)
-                        self.metabases_instances[trg_database_name]['instance'].import_dashboard(dashboard)
-                        self.reload_if_needed(trg_database_name)
-                        dashboards_migrated_count = dashboards_migrated_count + 1
+                        # failed couvre tous les essais : une collection ou une question en échec définitif n'est plus dans la file
+                        # mais bloque toujours ce qui en dépend
+                        if kind == "collections" : collection_id = (src_collections[src_id].get('details') or {}).get('parent_id')
+                        else : collection_id = self.find_in_collections(src_database_name, kind, src_id)[0]
+                        collection_error = failed.get( ("collections", collection_id) )
+                        if collection_error is not None :
+                            if getattr(collection_error, "retryable", False) : raise MissingDependencyError(f"La collection de cet objet n'a pas pu être migrée.")
+                            raise SyncError(f"La collection de cet objet ne pourra pas être migrée : {collection_error}")
+                        card_id = self.failed_card_dependency(src_database_name, src_id, failed) if kind == "cards" else None
+                        if card_id is not None :
+                            raise SyncError(f"La question {card_id} dont dépend cet objet ne pourra pas être migrée.")
+
+                        new_id, converted = self.sync_object(src_database_name, trg_database_name, kind, src_id)
+                        failed.pop( (kind, src_id), None )
+                        if kind == "dashboards" :
+                            imported_dashboards[new_id] = converted
+                            imported_dashboards_src_ids[new_id] = src_id
+
+                    except requests.exceptions.RequestException as e :
+                        failed[(kind, src_id)] = HTTPSyncError(str(e))
+                    except SyncError as e :
+                        failed[(kind, src_id)] = e
                     except Exception as e :
-                        if "EMPTY" in str(e) :
-                            dashboard_is_empty = dashboard_is_empty + 1
-                            if dashboard_is_empty < 2 :
-                                need_retry = True
-                            else :
-                                logger.error(f"Deux fois que le dashboard est vide, on n'insiste pas.")
-                        elif "MISSING-TABLE" in str(e) :
-                            need_retry = True    
-                        else :
-                            logger.debug(f"DEBUG : avant conversion : {dashboard}")
-                            logger.debug(traceback.format_exc())
-                            logger.warning(f"🟠 WARN - Impossible de migrer le dashboard {dashboard_id} : {e}")
-                            break
-                        continue
+                        logger.debug(traceback.format_exc())
+                        failed[(kind, src_id)] = e
+
+                    error = failed.get( (kind, src_id) )
+                    if error is None : continue
+
+                    if getattr(error, "retryable", False) : retry_queue.append( (kind, src_id) )
+                    logger.warning(f"🟠 WARN - Impossible de migrer {kind}[{src_id}] de {src_database_name} ({type(error).__name__}) : {error}")
+
+                for dashboard_id in self.verify_dashboards(trg_database_name, imported_dashboards) :
+                    src_id = imported_dashboards_src_ids[dashboard_id]
+                    failed[("dashboards", src_id)] = EmptyDashboardError(f"Le dashboard {dashboard_id} est vide ou incomplet.")
+                    retry_queue.append( ("dashboards", src_id) )
+
+                # Une question peut passer avant celle dont elle dépend : on propage les échecs définitifs à toute la file
+                while True :
+                    blocked = { item : self.failed_card_dependency(src_database_name, item[1], failed) for item in retry_queue if item[0] == "cards" }
+                    blocked = { item : card_id for item, card_id in blocked.items() if card_id is not None }
+                    if not blocked : break
+                    for item, card_id in blocked.items() :
+                        failed[item] = SyncError(f"La question {card_id} dont dépend cet objet ne pourra pas être migrée.")
+                        retry_queue.remove(item)
+                        logger.warning(f"🟠 WARN - Impossible de migrer {item[0]}[{item[1]}] de {src_database_name} (SyncError) : {failed[item]}")
+            finally :
+                # Les correspondances des objets déjà importés ne doivent pas être perdues sur une erreur
+                self.get_ledger(trg_database_name).save()
+
+            queue = retry_queue
+            if not queue : break
+
+        for kind in ["collections", "cards", "dashboards"] :
+            logger.info(f"{counts[kind] - len([ item for item in failed if item[0] == kind ])} {kind} migrées sur {counts[kind]}")
+
+        return { kind : [ counts[kind] - len([ item for item in failed if item[0] == kind ]), counts[kind],
+                          len([ item for item, error in failed.items() if item[0] == kind and getattr(error, "retryable", False) ]) ] for kind in counts }
+
+    def verify_dashboards(self, trg_database_name, imported_dashboards:dict) -> list:
+        """ Vérifie en une fois les dashboards importés ({id cible: dashboard converti}) et renvoie une seconde fois
+            ceux qui sont revenus vides ou incomplets. Retourne les IDs toujours en échec.
+        """
+        if not imported_dashboards : return []
+        trg_instance = self.metabases_instances[trg_database_name]['instance']
+
+        expected_dashcards = { dashboard_id : len( dashboard.get('dashcards') or [] ) for dashboard_id, dashboard in imported_dashboards.items() }
+        failed = trg_instance.verify_dashboards(expected_dashcards)
+        if not failed : return []
+
+        for dashboard_id in failed :
+            try :
+                trg_instance.import_dashboard( dict(imported_dashboards[dashboard_id], id=dashboard_id) )
+            except Exception as e :
+                logger.warning(f"🟠 WARN - Impossible de renvoyer le dashboard {dashboard_id} : {e}")
+
+        still_failed = trg_instance.verify_dashboards({ dashboard_id : expected_dashcards[dashboard_id] for dashboard_id in failed })
+        for dashboard_id in still_failed :
+            logger.error(f"Deux fois que le dashboard {dashboard_id} est vide ou incomplet dans {trg_database_name}, on n'insiste pas.")
+        return still_failed
+
+    def get_orphans(self, src_database_name, trg_database_name) -> dict:
+        """ Retourne, par type d'objet, les IDs présents dans les collections 🔒 de la cible qui ne correspondent à aucun objet de la source.
+        """
+        src_collections = self.metabases_instances[src_database_name]['collections']
+        trg_instance = self.metabases_instances[trg_database_name]['instance']
+
+        expected = { "collections" : set(), "cards" : set(), "dashboards" : set() }
+        trg_roots = []
+        for collection_id, collection in src_collections.items() :
+            trg_collection_id = self.get_collection_id(src_database_name, collection_id, trg_database_name)
+            if not trg_collection_id : continue
+            expected["collections"].add(trg_collection_id)
+            if len( self.get_collection_path(src_database_name, collection_id) ) == 1 :
+                trg_roots.append(trg_collection_id)
+
+            for kind, get_id in [ ("cards", self.get_card_id), ("dashboards", self.get_dashboard_id) ] :
+                for object_id in (collection.get(kind) or {}).keys() :
+                    trg_object_id = get_id(src_database_name, object_id, trg_database_name)
+                    if trg_object_id : expected[kind].add(str(trg_object_id))
+
+        trg_subtree = set()
+        for root_id in trg_roots :
+            trg_subtree.update( trg_instance.trouver_collections_dependantes(root_id) )
+
+        orphans = { "collections" : sorted( trg_subtree - expected["collections"] ), "cards" : [], "dashboards" : [] }
+        for collection_id in trg_subtree - set(orphans["collections"]) :
+            collection = self.metabases_instances[trg_database_name]['collections'].get(collection_id) or {}
+            for kind in ["cards", "dashboards"] :
+                orphans[kind] = orphans[kind] + [ object_id for object_id in (collection.get(kind) or {}).keys() if str(object_id) not in expected[kind] ]
+
+        return orphans
+
+    def reconcile_from_to(self, src_database_name, trg_database_name, dry_run=True, batch_size=20, max_archive=50) -> dict:
+        """ Archive dans la cible les objets des collections 🔒 qui n'existent plus dans la source.
+            En dry_run, se contente de lister. Refuse d'archiver au-delà de max_archive objets.
+        """
+        self.refresh_instances(src_database_name, trg_database_name)
 
-        logger.info(f"{collections_migrated_count} collections migrées sur {collections_count}")
-        logger.info(f"{cards_migrated_count} cards migrées sur {cards_count}")
-        logger.info(f"{dashboards_migrated_count} dashboards migrées sur {dashboards_count}")
-        
-    def print_structures(self, master_instance_name):
-        headers = ["Type","Nom"]
-        instances_names = list(self.metabases_instances.keys())
+        orphans = self.get_orphans(src_database_name, trg_database_name)
+        total = sum( len(ids) for ids in orphans.values() )
 
-        if not master_instance_name in instances_names : raise Exception(f"Instance {master_instance_name} en dehors de la liste : {instances_names}")
+        for kind, ids in orphans.items() :
+            for object_id in ids :
+                if kind == "collections" :
+                    found = self.metabases_instances[trg_database_name]['collections'].get(object_id)
+                else :
+                    found = self.find_in_collections(trg_database_name, kind, object_id)[1]
+                logger.info(f"🗑️ Orphelin dans {trg_database_name} : {kind}[{object_id}] '{(found or {}).get('name')}'")
 
-        other_instances_names = copy.copy(instances_names)
-        other_instances_names.remove(master_instance_name)
+        if dry_run or not total :
+            logger.info(f"{total} objets orphelins dans {trg_database_name}{', rien archivé (dry-run)' if dry_run else ''}.")
+            return orphans
 
-        orderred_other_instances_names = [master_instance_name]+other_instances_names
+        if total > max_archive :
+            logger.error(f"{total} objets orphelins dans {trg_database_name}, au-delà de la limite de {max_archive}. On n'archive rien, vérifiez avec dry_run=True.")
+            return orphans
 
-        for instance_name in orderred_other_instances_names :
-            headers.append(f"{instance_name}_id")
-        
-        tab = PrettyTable(headers)
+        trg_instance = self.metabases_instances[trg_database_name]['instance']
+        archived = {}
+        for kind in ["cards", "dashboards", "collections"] :
+            archived[kind] = trg_instance.archive_objects(kind, orphans[kind], batch_size=batch_size)
 
-        for db_id in self.metabases_instances[master_instance_name]['databases'].keys():
-            row = [ "database", self.metabases_instances[master_instance_name]['databases'][db_id]['db_name'], db_id ]
-            for instance_name in other_instances_names :
-                row.append( self.get_database_id(master_instance_name, db_id, instance_name) )
-            tab.add_row(row)
-
-            tables = self.metabases_instances[master_instance_name]['databases'][db_id]['tables']
-            for table_id in tables.keys():
-                row = [ "+ table", tables[table_id]['name'], table_id ]
-                for instance_name in other_instances_names :
-                    row.append( self.get_table_id(master_instance_name, table_id, instance_name) )
-        
-                tab.add_row(row)
-
-                fields = tables[table_id]['fields']
-                for field_id in fields.keys():
-                    row = [ "++ champ", fields[field_id]['name'], field_id ]
-                    for instance_name in other_instances_names :
-                        row.append( self.get_field_id(master_instance_name, field_id, instance_name) )
-                    
-                    tab.add_row(row)
-        
-        for collection_id in self.metabases_instances[master_instance_name]['collections'].keys():
-            row = [ "collection", self.metabases_instances[master_instance_name]['collections'][collection_id]['name'], collection_id ]
+        logger.info(f"{sum( len(ids) for ids in archived.values() )} objets archivés sur {total} orphelins dans {trg_database_name}.")
+        return archived
+
+    def build_index(self, instance_name) -> dict:
+        """ Index des objets de l'instance par clé de correspondance (noms, chemin de collection), construit en un seul parcours.
+        """
+        structure = self.metabases_instances[instance_name]
+        index = { "databases" : {}, "tables" : {}, "fields" : {}, "collections" : {}, "cards" : {}, "dashboards" : {}, "ids" : { "cards" : set(), "dashboards" : set() } }
+
+        for db_id, db in structure['databases'].items() :
+            index["databases"][db['db_name']] = db_id
+            for table_id, table in (db.get('tables') or {}).items() :
+                index["tables"][(db['db_name'], table['name'])] = table_id
+                for field_id, field in (table.get('fields') or {}).items() :
+                    index["fields"][(db['db_name'], table['name'], field['name'])] = field_id
+
+        for collection_id, collection in (structure.get('collections') or {}).items() :
+            index["collections"][self.get_collection_path(instance_name, collection_id)] = collection_id
+            for kind in ["cards", "dashboards"] :
+                for object_id, obj in (collection.get(kind) or {}).items() :
+                    index[kind][(collection_id, obj['name'])] = object_id
+                    index["ids"][kind].add(str(object_id))
+
+        return index
+
+    def iter_mapping_rows(self, master_instance_name, only_unmatched=False):
+        """ Génère une ligne par base, table, champ, collection, question et dashboard de l'instance maître,
+            avec l'ID correspondant dans chaque autre instance. Temps linéaire : tout passe par build_index.
+        """
+        instances_names = list(self.metabases_instances.keys())
+        if not master_instance_name in instances_names : raise Exception(f"Instance {master_instance_name} en dehors de la liste : {instances_names}")
+        other_instances_names = [ name for name in instances_names if name != master_instance_name ]
+
+        indexes = { name : self.build_index(name) for name in other_instances_names }
+        master = self.metabases_instances[master_instance_name]
+
+        def ledger_id(kind, src_id, instance_name):
+            entry = self.get_ledger(instance_name).get(master_instance_name, kind, src_id)
+            if not entry : return None
+            if kind == "collections" :
+                return entry['id'] if self.metabases_instances[instance_name]['collections'].get(entry['id']) else None
+            return entry['id'] if str(entry['id']) in indexes[instance_name]["ids"][kind] else None
+
+        def row(type, name, master_id, get_id):
+            _row = { "type" : type, "name" : name, master_instance_name : master_id }
             for instance_name in other_instances_names :
-                row.append( self.get_collection_id(master_instance_name, collection_id, instance_name) )
-            tab.add_row(row)
-
-            cards = self.metabases_instances[master_instance_name]['collections'][collection_id].get('cards') or {}
-            for card_id in cards.keys():
-                row = [ "+ question", cards[card_id]['name'], card_id ]
-                for instance_name in other_instances_names :
-                    row.append( self.get_card_id(master_instance_name, card_id, instance_name) ) 
-                tab.add_row(row)              
-
-            dashboards = self.metabases_instances[master_instance_name]['collections'][collection_id].get('dashboards') or {}
-            for dashboard_id in dashboards.keys():
-                row = [ "+ dashboard", dashboards[dashboard_id]['name'], dashboard_id ]
-                for instance_name in other_instances_names :
-                    row.append( self.get_dashboard_id(master_instance_name, dashboard_id, instance_name) )   
-                tab.add_row(row)  
+                _row[instance_name] = get_id(instance_name)
+            if only_unmatched and all( _row[instance_name] is not None for instance_name in other_instances_names ) :
+                return None
+            return _row
+
+        for db_id, db in master['databases'].items() :
+            db_name = db['db_name']
+            _row = row("database", db_name, db_id, lambda i: indexes[i]["databases"].get(db_name))
+            if _row : yield _row
+
+            for table_id, table in (db.get('tables') or {}).items() :
+                table_name = table['name']
+                _row = row("+ table", table_name, table_id, lambda i: indexes[i]["tables"].get((db_name, table_name)))
+                if _row : yield _row
+
+                for field_id, field in (table.get('fields') or {}).items() :
+                    _row = row("++ champ", field['name'], field_id, lambda i: indexes[i]["fields"].get((db_name, table_name, field['name'])))
+                    if _row : yield _row
+
+        for collection_id, collection in (master.get('collections') or {}).items() :
+            path = self.get_collection_path(master_instance_name, collection_id)
+            trg_collection_ids = { i : ledger_id("collections", collection_id, i) or indexes[i]["collections"].get(path) for i in other_instances_names }
+            _row = row("collection", collection['name'], collection_id, lambda i: trg_collection_ids[i])
+            if _row : yield _row
+
+            for kind, type in [ ("cards", "+ question"), ("dashboards", "+ dashboard") ] :
+                for object_id, obj in (collection.get(kind) or {}).items() :
+                    _row = row(type, obj['name'], object_id, lambda i: ledger_id(kind, object_id, i) or indexes[i][kind].get((trg_collection_ids[i], obj['name'])))
+                    if _row : yield _row
+
+    def write_mapping_report(self, master_instance_name, filename, only_unmatched=False) -> int:
+        """ Écrit au fil de l'eau le rapport de correspondances en CSV, ou en JSON Lines si filename se termine par .jsonl.
+            Retourne le nombre de lignes écrites.
+        """
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        count = 0
+        with open(filename, 'w', newline='') as f:
+            if filename.endswith('.jsonl') :
+                for _row in self.iter_mapping_rows(master_instance_name, only_unmatched) :
+                    f.write(json.dumps(_row, ensure_ascii=False) + "\n")
+                    count = count + 1
+            else :
+                fieldnames = ["type", "name", master_instance_name] + [ name for name in self.metabases_instances.keys() if name != master_instance_name ]
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                for _row in self.iter_mapping_rows(master_instance_name, only_unmatched) :
+                    writer.writerow(_row)
+                    count = count + 1
+
+        logger.info(f"Rapport de correspondances ({count} lignes) sauvegardé ici : {filename}")
+        return count
+
+    def print_structures(self, master_instance_name, only_unmatched=False):
+        instances_names = list(self.metabases_instances.keys())
+        if not master_instance_name in instances_names : raise Exception(f"Instance {master_instance_name} en dehors de la liste : {instances_names}")
+        orderred_instances_names = [master_instance_name] + [ name for name in instances_names if name != master_instance_name ]
+
+        tab = PrettyTable(["Type","Nom"] + [ f"{instance_name}_id" for instance_name in orderred_instances_names ])
+        for _row in self.iter_mapping_rows(master_instance_name, only_unmatched) :
+            tab.add_row([ _row["type"], _row["name"] ] + [ _row[instance_name] for instance_name in orderred_instances_names ])
 
         print(tab)
 
+class Scheduler():
+    """ Enchaîne les synchronisations vers les cibles déclarées dans settings.json ("targets") :
+        priorités, fenêtres de maintenance, budget global de requêtes simultanées et relance des cibles en échec.
+    """
+    def __init__(self, comparator:Comparator, SETTINGS:dict, state_file="_exports/scheduler.json") -> None:
+        self.comparator = comparator
+        self.TARGETS = SETTINGS.get("targets") or {}
+
+        scheduler_settings = SETTINGS.get("scheduler") or {}
+        self.MAX_PARALLEL_SYNCS = scheduler_settings.get("max_parallel_syncs", 2)
+        self.MAX_ATTEMPTS = scheduler_settings.get("max_attempts", 3)
+        self.BACKOFF = scheduler_settings.get("backoff", 60)
+        self.BUDGET = threading.BoundedSemaphore( scheduler_settings.get("max_concurrency", 8) )
+
+        self.STATE_FILE = state_file
+        self.STATE = ( os.path.exists(state_file) and load_json_from_file(state_file) ) or {}
+
+    @staticmethod
+    def in_maintenance_window(window, now=None) -> bool:
+        """ window = ["HH:MM", "HH:MM"], éventuellement à cheval sur minuit. Pas de fenêtre = toujours ouvert.
+        """
+        if not window : return True
+        now = ( now or datetime.now() ).strftime("%H:%M")
+        start, end = window
+        if start <= end :
+            return start <= now < end
+        return now >= start or now < end
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.STATE_FILE) or '.', exist_ok=True)
+        with open(self.STATE_FILE, 'w') as f:
+            json.dump(self.STATE, f, indent=1)
+
+    def sync_target(self, trg_name):
+        target = self.TARGETS[trg_name]
+        started = time.time()
+        result = self.comparator.sync_collections_from_to(target['source'], trg_name, refresh_source=False)
+        failed = { kind : total - migrated for kind, (migrated, total, _) in result.items() if migrated < total }
+        retryable = { kind : count for kind, (_, _, count) in result.items() if count }
+        return result, failed, retryable, time.time() - started
+
+    def run(self) -> dict:
+        # Une cible peut être la source d'une autre (A --> B --> C) : B doit être synchronisée avant C, sans boucle.
+        for trg_name in self.TARGETS.keys() :
+            chain, name = [], trg_name
+            while name in self.TARGETS :
+                if name in chain : raise Exception(f"Les cibles forment une boucle : {chain + [name]}")
+                chain.append(name)
+                name = self.TARGETS[name]['source']
+
+        instances = { name : structure['instance'] for name, structure in self.comparator.metabases_instances.items() }
+        sources = { target['source'] for target in self.TARGETS.values() }
+        for name in set(self.TARGETS.keys()) | sources :
+            instances[name].set_request_limits((self.TARGETS.get(name) or {}).get('max_concurrency'), self.BUDGET)
+        for src_name in sources :
+            self.comparator.refresh_instance(src_name)
+
+        pending = { trg_name : {"attempts" : 0, "not_before" : 0} for trg_name in self.TARGETS.keys() }
+        running = {}
+
+        def release_dependents(trg_name):
+            # La cible sert de source à d'autres : on récupère sa structure à jour avant de les lancer.
+            dependents = [ name for name in pending.keys() if self.TARGETS[name]['source'] == trg_name ]
+            if not dependents : return
+            try :
+                self.comparator.refresh_instance(trg_name)
+            except Exception as e :
+                logger.debug(traceback.format_exc())
+                for name in dependents :
+                    pending.pop(name)
+                    self.STATE[name] = dict(self.STATE.get(name) or {}, status="failed", error=f"source {trg_name} non rafraîchie : {e}", finished_at=datetime.now().isoformat())
+                    logger.error(f"{name} abandonnée, sa source {trg_name} n'a pas pu être rafraîchie : {e}")
+
+        def order(trg_name):
+            # Priorité d'abord (plus petite = plus urgente), puis les cibles les plus rapides la dernière fois.
+            return ( self.TARGETS[trg_name].get('priority', 0), (self.STATE.get(trg_name) or {}).get('duration') or 0 )
+
+        with ThreadPoolExecutor(max_workers=self.MAX_PARALLEL_SYNCS) as executor :
+            while pending or running :
+
+                for trg_name in sorted(pending.keys(), key=order) :
+                    if len(running) >= self.MAX_PARALLEL_SYNCS : break
+                    if pending[trg_name]['not_before'] > time.time() : continue
+                    source = self.TARGETS[trg_name]['source']
+                    if source in pending or source in [ name for name, _ in running.values() ] : continue
+
+                    job = pending.pop(trg_name)
+                    if not self.in_maintenance_window(self.TARGETS[trg_name].get('maintenance_window')) :
+                        logger.warning(f"🟠 WARN - {trg_name} hors de sa fenêtre de maintenance, on passe.")
+                        self.STATE[trg_name] = dict(self.STATE.get(trg_name) or {}, status="skipped", finished_at=datetime.now().isoformat())
+                        continue
+
+                    job['attempts'] = job['attempts'] + 1
+                    logger.info(f"🤖 Synchronisation {self.TARGETS[trg_name]['source']} --> {trg_name} (essai {job['attempts']}/{self.MAX_ATTEMPTS})")
+                    running[executor.submit(self.sync_target, trg_name)] = (trg_name, job)
+
+                if not running :
+                    time.sleep(1)
+                    continue
+
+                done, _ = wait(running.keys(), timeout=1, return_when=FIRST_COMPLETED)
+                for future in done :
+                    trg_name, job = running.pop(future)
+                    state = { "attempts" : job['attempts'], "finished_at" : datetime.now().isoformat() }
+                    try :
+                        result, failed, retryable, duration = future.result()
+                        state.update(result=result, duration=duration, failed=failed)
+                        error = f"objets en échec : {failed}" if failed else None
+                    except Exception as e :
+                        logger.debug(traceback.format_exc())
+                        error, retryable = str(e), True
+
+                    if not error :
+                        self.STATE[trg_name] = dict(state, status="ok")
+                        logger.info(f"🟢 {trg_name} synchronisée ({state['duration']:.0f}s)")
+                    elif retryable and job['attempts'] < self.MAX_ATTEMPTS :
+                        job['not_before'] = time.time() + self.BACKOFF * 2**(job['attempts']-1)
+                        pending[trg_name] = job
+                        self.STATE[trg_name] = dict(state, status="retrying", error=error)
+                        logger.warning(f"🟠 WARN - {trg_name} en échec ({error}), nouvel essai dans {self.BACKOFF * 2**(job['attempts']-1)}s")
+                    else :
+                        self.STATE[trg_name] = dict(state, status="failed", error=error)
+                        reason = f"après {job['attempts']} essais" if retryable else "sans échec réessayable, on ne relance pas"
+                        logger.error(f"{trg_name} en échec ({reason}) : {error}")
+                    if trg_name not in pending : release_dependents(trg_name)
+                    self.save_state()
+
+        self.save_state()
+        logger.info(f"🤖 Bilan : { {trg_name : state.get('status') for trg_name, state in self.STATE.items() if trg_name in self.TARGETS} }")
+        return self.STATE
+
 if __name__ == "__main__":
     main()        
\ No newline at end of file